@@ -24,9 +24,143 @@ import plotly.graph_objs as go
 import plotly as py
 import plotly.express as px
 from scipy.stats import norm
+from scipy import sparse
+from scipy.spatial import cKDTree
+from numba import njit, prange
 import time
 
 
+@njit(cache=True)
+def csr_dot_pair(indptr, indices, data, x):
+    """
+    Calculate C @ x and (C != 0) @ x in a single pass over the CSR structure of C
+    """
+
+    n = indptr.shape[0] - 1
+    out = np.zeros(n)
+    out_bool = np.zeros(n)
+    for i in range(n):
+        for k in range(indptr[i], indptr[i + 1]):
+            x_k = x[indices[k]]
+            out[i] += data[k] * x_k
+            out_bool[i] += x_k
+    return out, out_bool
+
+
+@njit(cache=True)
+def add_spikes(spikes, syn_dec, syn_rise, indptr, indices, data, g_dec, g_rise, g_bool_dec, g_bool_rise, with_bool):
+    """
+    Add the CSC columns of the spiking neurons to the (already decayed) synaptic state in a single pass, for both C
+    and (C != 0) if with_bool. A new spike replaces the presynaptic neuron's previous one
+    """
+
+    for j in range(spikes.shape[0]):
+        if not spikes[j]:
+            continue
+        d_dec = 1 - syn_dec[j]
+        d_rise = 1 - syn_rise[j]
+        syn_dec[j] = 1
+        syn_rise[j] = 1
+        for k in range(indptr[j], indptr[j + 1]):
+            i = indices[k]
+            g_dec[i] += data[k] * d_dec
+            g_rise[i] += data[k] * d_rise
+            if with_bool:
+                g_bool_dec[i] += d_dec
+                g_bool_rise[i] += d_rise
+
+
+@njit(cache=True, fastmath=True, parallel=True)
+def step_LIF(Vs, Is, spikes, spikes_t, ref, t, dt, Vr, Vth, Vreset, R, tau, J, decay_dec, decay_rise, syn_dec,
+             syn_rise, g_dec, g_rise, EPSC, indptr, indices, data, I_ext, I_in, in_indptr, in_indices, in_data, V_rec):
+    """
+    Single LIF time step: integrate the neurons out of their refractory period, detect spikes, record the potential
+    (V_rec, 0 for spiking neurons) and reset, update the event driven EPSC and set Is to the currents of the next
+    step (injected + input synapses (CSR) + EPSC)
+    """
+
+    N = Vs.shape[0]
+    spike_num = 0
+    for i in prange(N):
+        # Input synaptic current (uses the potential before the update)
+        I_cur = I_ext[i]
+        for k in range(in_indptr[i], in_indptr[i + 1]):
+            I_cur += (in_data[k] - Vs[i]) * I_in[in_indices[k]]
+
+        if t - spikes_t[i] > ref[i] or spikes_t[i] == -1:
+            Vs[i] += dt * (Vr - Vs[i] + Is[i] * R) / tau
+        Is[i] = I_cur
+        spikes[i] = Vs[i] > Vth
+        if spikes[i]:
+            spike_num += 1
+            spikes_t[i] = t
+            V_rec[i] = 0
+            Vs[i] = Vreset
+        else:
+            V_rec[i] = Vs[i]
+        syn_dec[i] *= decay_dec
+        syn_rise[i] *= decay_rise
+        g_dec[i] *= decay_dec
+        g_rise[i] *= decay_rise
+
+    # Synaptic state only changes beyond the decay if a neuron spiked
+    if spike_num:
+        add_spikes(spikes, syn_dec, syn_rise, indptr, indices, data, g_dec, g_rise, g_dec, g_rise, False)
+
+    for i in prange(N):
+        EPSC[i] = J * (g_dec[i] - g_rise[i])
+        Is[i] += EPSC[i]
+
+
+@njit(cache=True, fastmath=True, parallel=True)
+def step_SFA(Vs, Is, spikes, spikes_t, n, Ia, t, dt, Vr, Vth, Vreset, R, tau, Vk, gk, alpha, tauN, J, decay_dec,
+             decay_rise, syn_dec, syn_rise, g_dec, g_rise, g_bool_dec, g_bool_rise, EPSC, indptr, indices, data, I_ext,
+             I_in, in_indptr, in_indices, in_data, V_rec):
+    """
+    Single SFA time step: update the adaptation current and integrate the neurons, detect spikes, record the
+    potential (V_rec, 0 for spiking neurons) and reset, update the dual exponential synaptic state and the EPSC
+    (with reversal potential) and set Is to the currents of the next step (injected + input synapses (CSR) + EPSC)
+    """
+
+    N = Vs.shape[0]
+    spike_num = 0
+    for i in prange(N):
+        # Input synaptic current (uses the potential before the update)
+        I_cur = I_ext[i]
+        for k in range(in_indptr[i], in_indptr[i + 1]):
+            I_cur += (in_data[k] - Vs[i]) * I_in[in_indices[k]]
+
+        # Fraction of open conductance and adaptation current
+        opening = 1.0 if t - spikes_t[i] <= 1 and spikes_t[i] > 0 else 0.0
+        n[i] = n[i] - dt * ((n[i] / tauN) - alpha * (1 - n[i]) * opening)
+        Ia[i] = gk * n[i] * (Vs[i] - Vk)
+
+        Vs[i] += dt * (Vr - Vs[i] + (Is[i] - Ia[i]) * R) / tau
+        Is[i] = I_cur
+        spikes[i] = Vs[i] > Vth
+        if spikes[i]:
+            spike_num += 1
+            spikes_t[i] = t
+            V_rec[i] = 0
+            Vs[i] = Vreset
+        else:
+            V_rec[i] = Vs[i]
+        syn_dec[i] *= decay_dec
+        syn_rise[i] *= decay_rise
+        g_dec[i] *= decay_dec
+        g_rise[i] *= decay_rise
+        g_bool_dec[i] *= decay_dec
+        g_bool_rise[i] *= decay_rise
+
+    # Synaptic state only changes beyond the decay if a neuron spiked
+    if spike_num:
+        add_spikes(spikes, syn_dec, syn_rise, indptr, indices, data, g_dec, g_rise, g_bool_dec, g_bool_rise, True)
+
+    for i in prange(N):
+        V_i = 0.0 if spikes[i] else Vs[i]
+        EPSC[i] = J * (g_dec[i] - g_rise[i]) - J * (g_bool_dec[i] - g_bool_rise[i]) * V_i  # Adaptation
+        Is[i] += EPSC[i]
+
 
 class Network:
 
@@ -34,7 +168,7 @@ class Network:
                  ref=(2, 3),lamb_in=2,tau_psc=(6, 3), keep_data=1, dt=0.01, tauRise=1, tauDec=6.5, Vk=-60.6, gk=10,
                  alpha=0.02, tauN=230, J=0.0615, input_num=1, clusters=1, cluster_pr=0.1,
                  V_syn={(1, 1): 5, (1, 0): 25, (0, 1): -20, (0, 0): -20},connect_const={(1, 1): 0.3, (1, 0): 0.2, (0, 1): 0.4,(0, 0): 0.1},
-                 cluster_map = [],connect_type = 0):
+                 cluster_map = [],connect_type = 0, dtype=np.float64):
         """
         Initialize network
             model - Neurons spiking model
@@ -56,6 +190,8 @@ class Network:
             cluster_map - Array (size #neurons) that maps each neuron to a cluster (0 and 1)
             connect_type - Connection type of neurons from different classes. if 0 connect by distance between neurons,
                                                                             if 1 connect by distance from cluster center
+            dtype - Floating point type of the neurons state and synaptic weights (spike times are kept float64).
+                    np.float32 is faster but the trajectories diverge from float64 (only statistics as rates are kept)
 
             // SFA parameters
             Vk - K+ reversal potential (mV)
@@ -80,6 +216,8 @@ class Network:
         self.dim[1] = dim[1] * clusters
 
         self.neuron_num = np.prod(self.dim)
+        self.positions = np.stack(np.unravel_index(np.arange(self.neuron_num), self.dim), axis=1)  # Neurons positions
+        self.r0 = self.get_r(self.positions[:, 1], self.positions[:, 2])  # Neurons polar positions (LFP)
 
         if clusters > 1:
             if len(cluster_map)==0:
@@ -104,22 +242,12 @@ class Network:
 
 
         self.lamb_in = lamb_in
-        self.connections = np.zeros([self.neuron_num, self.neuron_num])
         self.input_connections = np.zeros([self.neuron_num, self.input_num])
         self.tau_psc = np.array(tau_psc)
         self.lamb = lamb
         self.keep_data = keep_data
         self.model_type = model
 
-        if model == 'SFA':
-            self.model = self.SFA
-            self.synaptic_current = self.synaptic_current_SFA
-            self.input_current = self.input_current_SFA
-
-        if model == 'LIF' or model == 'SOC':
-            self.model = self.LIF
-            self.synaptic_current = self.synaptic_current_LIF
-            self.input_current = self.input_current_LIF
         self.fig = None
         # Choose inhibitory neurons and generate connections
         self.inh_idx = np.sort(
@@ -128,11 +256,19 @@ class Network:
         self.type_array = np.ones(self.neuron_num, dtype=int)
         self.type_array[self.inh_idx] = 0
         self.V_syn = V_syn
+        self.dtype = dtype
+
+        # Lookup tables of V_syn and connect_const indexed by (i is excitatory, j is excitatory)
+        self.V_syn_table = np.array([[V_syn[(0, 0)], V_syn[(0, 1)]], [V_syn[(1, 0)], V_syn[(1, 1)]]], dtype=float)
+        self.connect_table = np.array([[connect_const[(0, 0)], connect_const[(0, 1)]],
+                                       [connect_const[(1, 0)], connect_const[(1, 1)]]], dtype=float)
 
         self.generate_connections()
 
-        self.connections_bool = self.connections != 0
-        self.in_connections_bool = self.input_connections != 0
+        self.input_connections_csr = sparse.csr_matrix(self.input_connections, dtype=self.dtype)
+
+        # Column compressed copy for event driven EPSC (fast access to the spiking neurons' columns)
+        self.connections_csc = self.connections_csr.tocsc()
 
         # SFA parameters
         self.Vk = Vk
@@ -142,6 +278,8 @@ class Network:
         self.J = J
         self.tauRise = tauRise
         self.tauDec = tauDec
+        self.decay_dec = np.exp(-self.dt / self.tauDec)  # Synaptic decay per time step
+        self.decay_rise = np.exp(-self.dt / self.tauRise)  # Synaptic rise per time step
 
         self.reset_history()
 
@@ -156,22 +294,33 @@ class Network:
         else:
             self.activity_size = self.neuron_num
 
-        self.spikes = np.zeros(self.neuron_num, dtype=int)  # Current spiking neurons
-        self.spikes_in = np.zeros(self.input_num, dtype=int)  # Current spiking neurons
+        self.spikes = np.zeros(self.neuron_num, dtype=bool)  # Current spiking neurons
+        self.spikes_in = np.zeros(0, dtype=int)  # Current spiking inputs (indices)
         self.spikes_syn = np.zeros(self.activity_size, dtype=int)
         self.spikes_t = np.full(self.neuron_num, -1, dtype=float)  # Neurons last spike
         self.spikes_t_syn = np.full(self.neuron_num, -1, dtype=float)  # Neurons last spike synapse
-        self.Vs = np.full(self.neuron_num, self.Vr, dtype=float)  # Current potentials
-        self.Is = np.zeros(self.neuron_num)  # Current currents
-        self.EPSC = np.zeros(self.neuron_num)  # Current post synaptic currents
-        self.n = np.zeros(self.neuron_num)  # Current fraction of open conductance
-        self.Ia = np.zeros(self.neuron_num)  # Current adaptation current (nA)
+        self.Vs = np.full(self.neuron_num, self.Vr, dtype=self.dtype)  # Current potentials
+        self.Is = np.zeros(self.neuron_num, dtype=self.dtype)  # Current currents
+        self.EPSC = np.zeros(self.neuron_num, dtype=self.dtype)  # Current post synaptic currents
+        self.n = np.zeros(self.neuron_num, dtype=self.dtype)  # Current fraction of open conductance
+        self.Ia = np.zeros(self.neuron_num, dtype=self.dtype)  # Current adaptation current (nA)
         self.type_array[self.inh_idx] = 0  # TODO
-        self.active = np.zeros(self.activity_size, dtype=int)
+        self.ref_neurons = self.ref[self.type_array].astype(float)  # Refractory period of each neuron
+        self.active = np.ones(self.neuron_num, dtype=bool)  # Neurons out of their refractory period (NumPy path)
         self.A = np.zeros(self.activity_size)
         self.isi = []
         self.input_t = np.full(self.input_num, -1, dtype=float)
 
+        # Synaptic state (event driven EPSC)
+        self.syn_dec = np.zeros(self.neuron_num, dtype=self.dtype)  # Presynaptic decay term exp(-(t-t_spike)/tauDec)
+        self.syn_rise = np.zeros(self.neuron_num, dtype=self.dtype)  # Presynaptic rise term exp(-(t-t_spike)/tauRise)
+        self.g_dec = np.zeros(self.neuron_num, dtype=self.dtype)  # Postsynaptic weighted decay term
+        self.g_rise = np.zeros(self.neuron_num, dtype=self.dtype)  # Postsynaptic weighted rise term
+        self.g_bool_dec = np.zeros(self.neuron_num, dtype=self.dtype)  # Postsynaptic decay term over connected synapses (SFA)
+        self.g_bool_rise = np.zeros(self.neuron_num, dtype=self.dtype)  # Postsynaptic rise term over connected synapses (SFA)
+        self.in_dec = np.zeros(self.input_num, dtype=self.dtype)  # Input decay term exp(-(t-t_spike)/tauDec)
+        self.in_rise = np.zeros(self.input_num, dtype=self.dtype)  # Input rise term exp(-(t-t_spike)/tauRise)
+
     def LIF(self):
         """
         Caluclate LIF derivative:
@@ -180,69 +329,38 @@ class Network:
         return (self.Vr - self.Vs[self.active] + self.Is[self.active] * self.R) / self.tau
 
 
-    def synaptic_current_LIF(self):
+    def input_current(self):
         """
-        Calculate LIF post synaptic currents
+        Calculate input synaptic currents
         """
 
-        dt = self.t - self.spikes_t
-        Isyn = self.J * (np.exp(-dt / self.tauDec) - np.exp(-dt / self.tauRise))
-        Isyn[self.spikes_t < 0] = 0
+        return self.J * (self.in_dec - self.in_rise)
 
-        return Isyn
-
-    def input_current_LIF(self):
+    def update_synapses(self):
         """
-        Calculate LIF input synaptic currents
+        Event driven update of the synaptic state: decay all terms by a constant factor and only add the columns
+        of the neurons that spiked in the current step (the new spike replaces the presynaptic neuron's previous one)
         """
 
-        dt = self.t - self.input_t
-        Isyn = self.J * (np.exp(-dt / self.tauDec) - np.exp(-dt / self.tauRise))
-        Isyn[self.input_t < 0] = 0
-
-        return Isyn
-
-    def K_frac(self):
-        """
-        Calculate fraction of open conductance (SFA)
-        """
+        self.syn_dec *= self.decay_dec
+        self.syn_rise *= self.decay_rise
+        self.g_dec *= self.decay_dec
+        self.g_rise *= self.decay_rise
 
-        time = np.logical_and(self.t - self.spikes_t <= 1, self.spikes_t > 0) # Yaron =!0
-        self.n = self.n - self.dt * ((self.n / self.tauN) - self.alpha * (1 - self.n) * time)
+        if self.spikes.any():
+            C = self.connections_csc
+            add_spikes(self.spikes, self.syn_dec, self.syn_rise, C.indptr, C.indices, C.data, self.g_dec, self.g_rise,
+                       self.g_bool_dec, self.g_bool_rise, False)
 
-    def SFA(self):
+    def update_inputs(self):
         """
-        Calculate SFA derivatives
+        Decay the input synaptic state and restart it for the inputs that spiked in the current step
         """
 
-        self.K_frac()
-        self.Ia = self.gk * self.n * (self.Vs - self.Vk)
-        self.Ia = self.gk * self.n * (self.Vs - self.Vk)
-
-        return (self.Vr - self.Vs + (self.Is - self.Ia) * self.R) / self.tau
-
-
-
-    def synaptic_current_SFA(self):
-        """
-        Calculate SFA synaptic currents
-        """
-
-        dt = self.t - self.spikes_t
-        Isyn = self.J * (np.exp(-dt / self.tauDec) - np.exp(-dt / self.tauRise))
-        Isyn[self.spikes_t < 0] = 0 #Yaron ==0
-        return Isyn
-
-    def input_current_SFA(self):
-        """
-        Calculate SFA input synaptic currents
-        """
-
-        dt = self.t - self.input_t
-        Isyn = self.J * (np.exp(-dt / self.tauDec) - np.exp(-dt / self.tauRise))
-        Isyn[self.input_t < 0] = 0 #Yaron
-
-        return Isyn
+        self.in_dec *= self.decay_dec
+        self.in_rise *= self.decay_rise
+        self.in_dec[self.spikes_in] = 1
+        self.in_rise[self.spikes_in] = 1
 
 
     def run_model(self, I, input_type=0):
@@ -254,137 +372,171 @@ class Network:
 
         self.reset_history()
         t = I.shape[0]
+        self.t_seq = np.zeros(int(t) + 1)  # Simulation time steps (ms)
+        self.t_seq[1:] = np.linspace(self.dt, t * self.dt, t)
 
         # Save simulation history
         if self.keep_data:
-            self.Vseq = np.zeros((self.neuron_num, int(t) + 1))
-            self.Vseq[:, 0] = self.Vs
-            self.spikes_seq = np.zeros((self.neuron_num, int(t) + 1))
-            self.EPSC_seq = np.zeros((self.neuron_num, int(t) + 1))
-            self.A_seq = np.zeros((self.activity_size, int(t) + 1))
-            self.n_seq = np.zeros((self.neuron_num, int(t) + 1))
+            # Recorded as float32 (spikes as uint8) to reduce the memory traffic of the logging.
+            # Time major (time x neurons) so each step writes one contiguous row
+            self.Vseq = np.empty((int(t) + 1, self.neuron_num), dtype=np.float32)
+            self.Vseq[0] = self.Vs
+            self.spikes_seq = np.empty((int(t) + 1, self.neuron_num), dtype=np.uint8)
+            self.spikes_seq[0] = 0
+            self.EPSC_seq = np.empty((int(t) + 1, self.neuron_num), dtype=np.float32)
+            self.EPSC_seq[0] = self.EPSC
+            self.A_seq = np.empty((int(t) + 1, self.activity_size), dtype=np.float32)
+            self.A_seq[0] = self.A
+            self.n_seq = np.empty((int(t) + 1, self.neuron_num), dtype=np.float32)
+            self.n_seq[0] = self.n
             self.I_seq = I
 
+        # Step buffers (injected currents, input synapses currents and the potential record if not kept)
+        I_ext = np.zeros(self.neuron_num)
+        I_in = np.zeros(self.input_num, dtype=self.dtype)
+        V_rec = None if self.keep_data else np.empty(self.neuron_num, dtype=np.float32)
+
         # Simulate numerically
-        for i, t_cur in enumerate(np.linspace(self.dt, t * self.dt, t), start=1):
+        for i, t_cur in enumerate(self.t_seq[1:], start=1):
             self.t = t_cur
 
-            if self.model_type == 'LIF':
-                # LIF neurons have refractory period
-                self.active = np.nonzero(
-                    np.logical_or(self.t - self.spikes_t > self.ref[self.type_array], self.spikes_t == -1))
-                active_neurons = self.active
-
-            if self.model_type == 'SFA':
-                self.active = np.arange(self.neuron_num, dtype=int)
-                active_neurons = self.active
-
             if input_type:
 
-                self.input_t[np.where(I[i - 1])] = t_cur
-                I_cur = self.input_connections.dot(self.input_current())-\
-                            (self.in_connections_bool.dot(self.input_current())*self.Vs)
+                self.spikes_in = np.flatnonzero(I[i - 1])
+                self.input_t[self.spikes_in] = t_cur
+                self.update_inputs()
+                I_in[:] = self.input_current()
             else:
-                I_cur = I[i - 1]
+                I_ext[:] = I[i - 1]
 
             # Update network
 
-            self.Vs[active_neurons] = self.Vs[active_neurons] + self.dt * self.model()
+            C_in = self.input_connections_csr
+            if self.model_type == 'LIF':
+                # LIF neurons have refractory period (compiled step, also sets Is for the next iteration)
+                C = self.connections_csc
+                if self.keep_data:
+                    V_rec = self.Vseq[i]
+                step_LIF(self.Vs, self.Is, self.spikes, self.spikes_t, self.ref_neurons, t_cur, self.dt, self.Vr,
+                         self.Vth, self.Vreset, self.R, self.tau, self.J, self.decay_dec, self.decay_rise,
+                         self.syn_dec, self.syn_rise, self.g_dec, self.g_rise, self.EPSC, C.indptr, C.indices,
+                         C.data, I_ext, I_in, C_in.indptr, C_in.indices, C_in.data, V_rec)
+            elif self.model_type == 'SFA':
+                # Compiled step, also sets Is for the next iteration
+                C = self.connections_csc
+                if self.keep_data:
+                    V_rec = self.Vseq[i]
+                step_SFA(self.Vs, self.Is, self.spikes, self.spikes_t, self.n, self.Ia, t_cur, self.dt, self.Vr,
+                         self.Vth, self.Vreset, self.R, self.tau, self.Vk, self.gk, self.alpha, self.tauN, self.J,
+                         self.decay_dec, self.decay_rise, self.syn_dec, self.syn_rise, self.g_dec, self.g_rise,
+                         self.g_bool_dec, self.g_bool_rise, self.EPSC, C.indptr, C.indices, C.data, I_ext, I_in,
+                         C_in.indptr, C_in.indices, C_in.data, V_rec)
+            else:
+                I_syn_in, I_syn_in_bool = csr_dot_pair(C_in.indptr, C_in.indices, C_in.data, I_in)
+                I_cur = I_ext + I_syn_in - I_syn_in_bool * self.Vs
 
-            self.spikes = self.Vs > self.Vth
+                # LIF neurons have refractory period
+                self.active = np.logical_or(t_cur - self.spikes_t > self.ref_neurons, self.spikes_t == -1)
+                self.Vs[self.active] += self.dt * self.LIF()
 
+                self.spikes = self.Vs > self.Vth
 
-            self.spikes_t[self.spikes] = t_cur
 
-            self.Vs[self.spikes] =  0 #Yaron =+40
-            if self.model_type == 'SFA':
-                self.EPSC = self.connections.dot(self.synaptic_current())-\
-                            (self.connections_bool.dot(self.synaptic_current())*self.Vs)  # Adaptation
-            else:
-                self.EPSC = self.connections.dot(self.synaptic_current())
+                np.copyto(self.spikes_t, t_cur, where=self.spikes)
 
-            if self.keep_data:
-                self.Vseq[:, i] = self.Vs
-                self.spikes_seq[:, i] = self.spikes
-                self.EPSC_seq[:, i] = self.EPSC
-                self.A_seq[:, i] = self.A
-                self.n_seq[:, i] = self.n
-            self.Vs[self.spikes] = self.Vreset
+                np.copyto(self.Vs, 0, where=self.spikes) #Yaron =+40
+                self.update_synapses()
+                self.EPSC = self.J * (self.g_dec - self.g_rise)
+
+                if self.keep_data:
+                    self.Vseq[i] = self.Vs
+                np.copyto(self.Vs, self.Vreset, where=self.spikes)
 
-            # Update input currents for next iteration
-            self.Is = I_cur + self.EPSC
+                # Update input currents for next iteration
+                self.Is[:] = I_cur + self.EPSC
+
+            if self.keep_data:
+                self.spikes_seq[i] = self.spikes
+                self.EPSC_seq[i] = self.EPSC
+                self.A_seq[i] = self.A
+                self.n_seq[i] = self.n
 
     def get_pos(self, idx):
         """
         Get a spacial position of an indicated neuron
             idx - index of the neuron
         """
-        return np.array(np.unravel_index(idx, self.dim))
+        return self.positions[idx].T
 
-    def fire_rate(self,window=1000):
-        return np.convolve(x, np.ones(N) / N, mode='valid')
+    def fire_rate(self, neuron_idx, window=1000):
+        """
+        Moving average fire rate of a neuron (spikes/ms)
+            neuron_idx - index of the neuron
+            window - Averaging window (time steps)
+        """
+        return np.convolve(self.spikes_seq[:, neuron_idx], np.ones(window) / (window * self.dt), mode='valid')
 
     def generate_connections(self):
         """
         Generate connections in the network as desribed in Mass, 2002.
         """
 
-        for i in np.arange(self.input_num):
-            cluster_cur = int(i >= self.input_num//self.clusters)
-            # Centered input
-            for j in np.where(self.cluster_map==cluster_cur)[0]:
-
-                neurons_dist = np.linalg.norm(self.get_pos(j) - (0, self.mid[cluster_cur][1], self.mid[cluster_cur][0]))
-
-                c = .242
-
-                connect_pr = c * np.exp(-(neurons_dist / (self.lamb_in)) ** 2)
-
-                #if self.clusters>1:
-                #    connect_pr = c * np.exp(-(neurons_dist / (self.lamb_in)) ** 2)
-                #else:
-                #    connect_pr = c
-
-                if np.random.rand() < connect_pr:
-                    self.input_connections[j, i] = self.V_syn[(not(np.isin(j, self.inh_idx)),1)]
-
-        for i in range(self.neuron_num):
-            for j in range(self.neuron_num):
-                if i == j:
-                    continue
-                # Get euclidean distance
-
-                if self.cluster_map[i] != self.cluster_map[j] and self.clusters > 1:
-                    c = self.cluster_pr
-                    if self.cluster_map[i] > self.cluster_map[j]:
-                        connect_pr = 0
-                    elif self.connect_type == 1:
-                        neurons_dist = (np.linalg.norm(
-                            self.get_pos(i) - (0, self.mid[self.cluster_map[i]][1], self.mid[self.cluster_map[i]][0])) +
-                                        np.linalg.norm(self.get_pos(j) - (
-                                        0, self.mid[self.cluster_map[j]][1], self.mid[self.cluster_map[j]][0]))) / 2
-                        # Calc connection probability
-                        connect_pr = c * np.exp(-(neurons_dist / self.lamb) ** 2)
-
-                    else:
-                        neurons_dist = np.linalg.norm(self.get_pos(i) - self.get_pos(j))
-
-                        # Calc connection probability
-                        connect_pr = c * np.exp(-(neurons_dist / self.lamb) ** 2)
-                else:
-                    neurons_dist = np.linalg.norm(self.get_pos(i) - self.get_pos(j))
-
-                    # Calc connection probability
-                    c = self.connect_const[(not (np.isin(i, self.inh_idx)), not (np.isin(j, self.inh_idx)))]
-                    connect_pr = c * np.exp(-(neurons_dist / self.lamb) ** 2)
-
-                #if self.model_type == 'SFA':
-                #    connect_pr = .242
-
-                if np.random.rand() < connect_pr:
-                    self.connections[i][j] = self.V_syn[(not(np.isin(i, self.inh_idx)), not(np.isin(j, self.inh_idx)))]
-                if i == j:
-                    self.connections[i][j] = 0
+        N = self.neuron_num
+        pos = self.positions
+        is_exc = self.type_array  # 1 - excitatory, 0 - inhibitory
+        cluster_map = np.asarray(self.cluster_map, dtype=int)
+        centers = np.column_stack((np.zeros(self.mid.shape[0]), self.mid[:, 1], self.mid[:, 0]))  # Clusters centers
+
+        # Centered input
+        input_cluster = (np.arange(self.input_num) >= self.input_num // self.clusters).astype(int)
+        input_dist = np.linalg.norm(pos[:, None, :] - centers[input_cluster][None, :, :], axis=-1)
+        c = .242
+        connect_pr = c * np.exp(-(input_dist / self.lamb_in) ** 2)
+        connect_pr[cluster_map[:, None] != input_cluster[None, :]] = 0
+        draws = np.random.rand(N, self.input_num) < connect_pr
+        self.input_connections = np.where(draws, self.V_syn_table[is_exc, 1][:, None], 0.)
+
+        # Candidate pairs: only distances where the connection probability is not negligible
+        min_pr = 1e-6
+        c_max = max(self.connect_table.max(), self.cluster_pr if self.clusters > 1 else 0)
+        cutoff = self.lamb * np.sqrt(np.log(c_max / min_pr)) if c_max > min_pr else 0
+        pairs = cKDTree(pos).query_pairs(r=cutoff, output_type='ndarray')
+
+        # Get euclidean distance and its gaussian factor once per unordered pair, then use them for both directions
+        neurons_dist = np.linalg.norm(pos[pairs[:, 0]] - pos[pairs[:, 1]], axis=1)
+        dist_factor = np.exp(-(neurons_dist / self.lamb) ** 2)
+        # Directed candidates: row (postsynaptic) and column (presynaptic) indices of connections
+        post = np.concatenate((pairs[:, 0], pairs[:, 1]))
+        pre = np.concatenate((pairs[:, 1], pairs[:, 0]))
+        dist_factor = np.concatenate((dist_factor, dist_factor))
+
+        if self.clusters > 1 and self.connect_type == 1:
+            # Neurons from different clusters connect by the distance from the clusters centers
+            # (cluster 1 -> 0 only, rows in cluster 0)
+            same_cluster = cluster_map[post] == cluster_map[pre]
+            post, pre, dist_factor = post[same_cluster], pre[same_cluster], dist_factor[same_cluster]
+
+            center_dist = np.linalg.norm(pos - centers[cluster_map], axis=1)
+            near = [np.flatnonzero((cluster_map == k) & (center_dist <= 2 * cutoff)) for k in (0, 1)]
+            post_c, pre_c = [idx.ravel() for idx in np.meshgrid(near[0], near[1], indexing='ij')]
+            dist_c = (center_dist[post_c] + center_dist[pre_c]) / 2
+            near_c = dist_c <= cutoff
+            post = np.concatenate((post, post_c[near_c]))
+            pre = np.concatenate((pre, pre_c[near_c]))
+            dist_factor = np.concatenate((dist_factor, np.exp(-(dist_c[near_c] / self.lamb) ** 2)))
+
+        c = self.connect_table[is_exc[post], is_exc[pre]]
+        if self.clusters > 1:
+            c[cluster_map[post] != cluster_map[pre]] = self.cluster_pr
+            c[cluster_map[post] > cluster_map[pre]] = 0
+
+        # Calc connection probability (directed, so each of i->j and j->i is drawn separately)
+        connect_pr = c * dist_factor
+
+        draws = np.random.rand(post.shape[0]) < connect_pr
+        post, pre = post[draws], pre[draws]
+        self.connections_csr = sparse.coo_matrix((self.V_syn_table[is_exc[post], is_exc[pre]], (post, pre)),
+                                                 shape=(N, N), dtype=self.dtype).tocsr()
 
     def plot_network(self):
         """
@@ -406,7 +558,7 @@ class Network:
         ye = []
         ze = []
 
-        for i in np.array(np.where(self.connections)).T:
+        for i in np.array(self.connections_csr.nonzero()).T:
             [ed1, ed2] = self.get_pos(i).T
 
             xe += [ed1[0], ed2[0], None]
@@ -434,8 +586,8 @@ class Network:
         else:
             [t1, tn] = window
 
-        [plt.scatter(np.nonzero(i)[0] * self.dt, np.full(np.nonzero(i)[0].shape[0], j), color='k', s=2) for j, i in
-         enumerate(self.spikes_seq)]
+        times, neurons = np.nonzero(self.spikes_seq)
+        plt.scatter(times * self.dt, neurons, color='k', s=2)
         plt.xlabel('Time (ms)')
         plt.xlim(t1 - 1, tn + 1)
         plt.yticks
@@ -459,12 +611,9 @@ class Network:
         ax = fig.add_subplot(111, projection='3d')
 
 
-        for j, i in enumerate(self.spikes_seq):
-            xs = np.nonzero(i)[0] * self.dt
-            [x, y, z] = self.get_pos(j)
-            ys = np.full(xs.shape[0],y)
-            zs = np.full(xs.shape[0], z)
-            ax.scatter(xs, ys, zs, color='k',s=2)
+        times, neurons = np.nonzero(self.spikes_seq)
+        [x, y, z] = self.get_pos(neurons)
+        ax.scatter(times * self.dt, y, z, color='k',s=2)
 
         ax.set_xlabel('Time (ms)')
         ax.set_ylabel('Y')
@@ -492,7 +641,7 @@ class Network:
         if np.isin(0, what):
             plt.figure()
 
-            plt.plot(np.linspace(0, self.t, int(self.t / self.dt) + 1), self.Vseq[pos, :])
+            plt.plot(self.t_seq, self.Vseq[:, pos])
             plt.xlabel('Time (ms)')
             plt.ylabel('V (mV)')
             plt.xlim(t1 - 1, tn + 1)
@@ -500,7 +649,7 @@ class Network:
 
         if np.isin(1, what):
             plt.figure()
-            plt.scatter(np.linspace(0, self.t, int(self.t / self.dt) + 1), self.spikes_seq[pos, :])
+            plt.scatter(self.t_seq, self.spikes_seq[:, pos])
             plt.xlabel('Time (ms)')
             plt.ylabel('Spikes')
             plt.xlim(t1 - 1, tn + 1)
@@ -508,7 +657,7 @@ class Network:
 
         if np.isin(2, what):
             plt.figure()
-            spike_times = np.where(self.spikes_seq[pos, int(t1 / self.dt):int(tn / self.dt)])[0]
+            spike_times = np.where(self.spikes_seq[int(t1 / self.dt):int(tn / self.dt), pos])[0]
             self.isi = np.array(
                 [(spike_times[i + 1] - spike_times[i]) * self.dt for i in range(spike_times.shape[0] - 1)])
             plt.plot(range(self.isi.shape[0]), self.isi)
@@ -519,7 +668,7 @@ class Network:
 
         if np.isin(3, what):
             plt.figure()
-            plt.plot(np.linspace(0, self.t, int(self.t / self.dt) + 1), self.A_seq[pos, :])
+            plt.plot(self.t_seq, self.A_seq[:, pos])
             plt.xlabel('Time (ms)')
             plt.ylabel('A')
             plt.xlim(t1 - 1, tn + 1)
@@ -527,7 +676,7 @@ class Network:
 
         if np.isin(4, what):
             plt.figure()
-            plt.plot(np.linspace(0, self.t, int(self.t / self.dt) + 1), self.EPSC_seq[pos, :])
+            plt.plot(self.t_seq, self.EPSC_seq[:, pos])
             plt.xlabel('Time (ms)')
             plt.ylabel('EPSC')
             plt.xlim(t1 - 1, tn + 1)
@@ -552,8 +701,8 @@ class Network:
         return(spike_train)
 
     def plot_spike_train(self, spike_train):
-        [plt.scatter(np.nonzero(i)[0] * self.dt, np.full(np.nonzero(i)[0].shape[0], j), color='darkblue', s=.2) for j, i in
-         enumerate(spike_train.T)]
+        times, inputs = np.nonzero(spike_train)
+        plt.scatter(times * self.dt, inputs, color='darkblue', s=.2)
         plt.xlabel('time (ms)')
 
     # LFP functions
@@ -567,11 +716,9 @@ class Network:
         return np.sqrt(r1[0] ** 2 + r2[0] ** 2 - r1[0] * r2[0] * np.cos(r1[1] - r2[1]))
 
     def get_phi(self,SPC, r, t, sigma, dim):
-        phi = np.zeros(t.shape[0])
-        for i, channel in enumerate(SPC):
-            z, x, y = self.get_pos(i)
-            r0 = self.get_r(x, y)
-            if np.any(r != r0):
-                dist = self.calc_dist(r, r0)
-                phi += channel[t] / (dist * (4 * np.pi * sigma))
-        return phi / (SPC.shape[0] - 1)
+        # SPC - time x neurons currents (e.g. EPSC_seq)
+        r = np.reshape(r, (3, -1))
+        others = np.any(r != self.r0, axis=0)  # Skip the neurons at the electrode position
+        dist = self.calc_dist(r, self.r0[:, others])
+        phi = SPC[t][:, others] @ (1 / (dist * (4 * np.pi * sigma)))
+        return phi / (SPC.shape[1] - 1)